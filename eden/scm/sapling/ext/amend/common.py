@@ -7,6 +7,8 @@
 
 from __future__ import absolute_import
 
+import itertools
+
 from sapling import (
     cmdutil,
     context,
@@ -19,6 +21,25 @@ from sapling import (
 
 from sapling.ext import rebase
 from sapling.i18n import _
+from sapling.node import hex
+
+_tweakdefaults = None
+_tweakdefaultschecked = False
+
+
+def _gettweakdefaults():
+    """Return the tweakdefaults extension module, or None if it is not
+    installed. The result is memoized so repeated restacks don't redo
+    the lookup (and the KeyError on the not-installed path).
+    """
+    global _tweakdefaults, _tweakdefaultschecked
+    if not _tweakdefaultschecked:
+        try:
+            _tweakdefaults = extensions.find("tweakdefaults")
+        except KeyError:
+            _tweakdefaults = None
+        _tweakdefaultschecked = True
+    return _tweakdefaults
 
 
 def restackonce(
@@ -47,11 +68,16 @@ def restackonce(
     else:
         predsquery = "predecessors(%d)"
 
-    allpredecessors = repo.revs(predsquery + " - (%d)", rev, rev)
-    fmt = "%s(%%ld) - %%ld - obsolete()" % (
-        "children" if childrenonly else "descendants"
+    # One fused expression rather than materializing the predecessor set
+    # and feeding it back through the parser as %ld; this parses/plans a
+    # single query and lets the engine share the subexpression.
+    predsexpr = "(%s - (%%d))" % predsquery
+    fmt = "%s(%s) - %s - obsolete()" % (
+        "children" if childrenonly else "descendants",
+        predsexpr,
+        predsexpr,
     )
-    descendants = repo.revs(fmt, allpredecessors, allpredecessors)
+    descendants = repo.revs(fmt, rev, rev, rev, rev)
 
     # Nothing to do if there are no descendants.
     if not descendants:
@@ -69,9 +95,8 @@ def restackonce(
         # use of "rebase" that does not contain user-provided revsets.
         ("devel", "legacy.revnum"): ""
     }
-    try:
-        tweakdefaults = extensions.find("tweakdefaults")
-    except KeyError:
+    tweakdefaults = _gettweakdefaults()
+    if tweakdefaults is None:
         # No tweakdefaults extension -- skip this since there is no wrapper
         # to set the metadata.
         pass
@@ -109,16 +134,12 @@ def bookmarksupdater(repo, oldids):
 
     def updatebookmarks(newid):
         tr = repo.currenttransaction()
-        dirty = False
+        changes = []
         for oldid in oldids:
-            changes = []
-            oldbookmarks = repo.nodebookmarks(oldid)
-            if oldbookmarks:
-                for b in oldbookmarks:
-                    changes.append((b, newid))
-                dirty = True
-            if dirty:
-                repo._bookmarks.applychanges(repo, tr, changes)
+            for b in repo.nodebookmarks(oldid):
+                changes.append((b, newid))
+        if changes:
+            repo._bookmarks.applychanges(repo, tr, changes)
 
     return updatebookmarks
 
@@ -129,91 +150,129 @@ def rewrite(repo, old, updates, head, newbases, commitopts, mutop=None):
     nodeid was actually created. If created is False, nodeid
     references a changeset existing before the rewrite call.
     """
+    if len(old.parents()) > 1:  # XXX remove this unnecessary limitation.
+        raise error.Abort(_("cannot amend merge changesets"))
+    base = old.p1()
+
+    # All of the preparation below only reads from the store, so it runs
+    # before the locks are acquired. Note that the current callers
+    # (metaedit, fold) hold wlock+lock+transaction across this call,
+    # which makes the acquisitions below re-entrant; the shorter
+    # critical section only benefits callers that don't.
+
+    headmf = head.manifest()
+    basemf = base.manifest()
+
+    def samefile(f):
+        if f in headmf:
+            if f in basemf:
+                # Matching filenodes mean matching contents; only read
+                # the file data when the nodes differ.
+                if headmf.get(f) == basemf.get(f) and head.flags(f) == base.flags(f):
+                    return True
+                a = head.filectx(f)
+                b = base.filectx(f)
+                return a.data() == b.data() and a.flags() == b.flags()
+            else:
+                return False
+        else:
+            return f not in basemf
+
+    # commit a new version of the old changeset, including the update:
+    # collect all files which might be affected, pruning files which
+    # were reverted by the updates, in a single deduplicating pass.
+    seen = set()
+    files = []
+    for f in itertools.chain(old.files(), *(u.files() for u in updates)):
+        if f in seen:
+            continue
+        seen.add(f)
+        if not samefile(f):
+            files.append(f)
+    files.sort()
+
+    # Recompute copies (avoid recording a -> b -> a). filectxfn below is
+    # the only consumer, so skip the manifest-diff walk entirely when
+    # there are no files to re-commit.
+    if files:
+        copied = copies.pathcopies(base, head)
+    else:
+        copied = {}
+
+    # commit version of these files as defined by head
+
+    # Precompute the filenode and flags for the paths commitctx will ask
+    # about, so each filectxfn call is a dict lookup rather than a
+    # manifest consult. File data stays lazy in the filectx.
+    filemeta = {}
+    for f in files:
+        if f in headmf:
+            fnode, flags = headmf.find(f)
+            filemeta[f] = (fnode, "l" in flags, "x" in flags)
+
+    def filectxfn(repo, ctx, path):
+        if path in filemeta:
+            fnode, islink, isexec = filemeta[path]
+            fctx = head.filectx(path, fileid=fnode)
+            mctx = context.memfilectx(
+                repo,
+                ctx,
+                fctx.path(),
+                fctx.data(),
+                islink=islink,
+                isexec=isexec,
+                copied=copied.get(path),
+            )
+            return mctx
+        return None
+
+    message = cmdutil.logmessage(repo, commitopts)
+    if not message:
+        message = old.description()
+
+    user = commitopts.get("user") or old.user()
+    # TODO: In case not date is given, we should take the old commit date
+    # if we are working one one changeset or mimic the fold behavior about
+    # date
+    date = commitopts.get("date") or None
+    # Don't evaluate old.extra() (a fresh dict off the changelog) when
+    # commitopts already carries an override.
+    if "extra" in commitopts:
+        extra = dict(commitopts["extra"])
+    else:
+        extra = dict(old.extra())
+    extra["branch"] = head.branch()
+    # One pass over updates feeds the mutation record, the log info,
+    # and the bookmark updater below.
+    updatenodes = [u.node() for u in updates]
+    mutinfo = mutation.record(repo, extra, updatenodes, mutop)
+    loginfo = {
+        "predecessors": " ".join(hex(n) for n in updatenodes),
+        "mutation": mutop,
+    }
+
+    new = context.memctx(
+        repo,
+        parents=newbases,
+        text=message,
+        files=files,
+        filectxfn=filectxfn,
+        user=user,
+        date=date,
+        extra=extra,
+        loginfo=loginfo,
+        mutinfo=mutinfo,
+    )
+
+    if commitopts.get("edit"):
+        new._text = cmdutil.commitforceeditor(repo, new)
+
     wlock = lock = tr = None
     try:
         wlock = repo.wlock()
         lock = repo.lock()
         tr = repo.transaction("rewrite")
-        if len(old.parents()) > 1:  # XXX remove this unnecessary limitation.
-            raise error.Abort(_("cannot amend merge changesets"))
-        base = old.p1()
-        updatebookmarks = bookmarksupdater(
-            repo, [old.node()] + [u.node() for u in updates]
-        )
-
-        # commit a new version of the old changeset, including the update
-        # collect all files which might be affected
-        files = set(old.files())
-        for u in updates:
-            files.update(u.files())
-
-        # Recompute copies (avoid recording a -> b -> a)
-        copied = copies.pathcopies(base, head)
-
-        # prune files which were reverted by the updates
-        def samefile(f):
-            if f in head.manifest():
-                a = head.filectx(f)
-                if f in base.manifest():
-                    b = base.filectx(f)
-                    return a.data() == b.data() and a.flags() == b.flags()
-                else:
-                    return False
-            else:
-                return f not in base.manifest()
-
-        files = [f for f in files if not samefile(f)]
-        # commit version of these files as defined by head
-        headmf = head.manifest()
-
-        def filectxfn(repo, ctx, path):
-            if path in headmf:
-                fctx = head[path]
-                flags = fctx.flags()
-                mctx = context.memfilectx(
-                    repo,
-                    ctx,
-                    fctx.path(),
-                    fctx.data(),
-                    islink="l" in flags,
-                    isexec="x" in flags,
-                    copied=copied.get(path),
-                )
-                return mctx
-            return None
-
-        message = cmdutil.logmessage(repo, commitopts)
-        if not message:
-            message = old.description()
-
-        user = commitopts.get("user") or old.user()
-        # TODO: In case not date is given, we should take the old commit date
-        # if we are working one one changeset or mimic the fold behavior about
-        # date
-        date = commitopts.get("date") or None
-        extra = dict(commitopts.get("extra", old.extra()))
-        extra["branch"] = head.branch()
-        mutinfo = mutation.record(repo, extra, [c.node() for c in updates], mutop)
-        loginfo = {
-            "predecessors": " ".join(c.hex() for c in updates),
-            "mutation": mutop,
-        }
-
-        new = context.memctx(
-            repo,
-            parents=newbases,
-            text=message,
-            files=files,
-            filectxfn=filectxfn,
-            user=user,
-            date=date,
-            extra=extra,
-            loginfo=loginfo,
-            mutinfo=mutinfo,
-        )
-
-        if commitopts.get("edit"):
-            new._text = cmdutil.commitforceeditor(repo, new)
+        updatebookmarks = bookmarksupdater(repo, [old.node()] + updatenodes)
         revcount = len(repo)
         newid = repo.commitctx(new)
         new = repo[newid]
@@ -232,40 +291,48 @@ def metarewrite(repo, old, newbases, commitopts):
     nodeid was actually created. If created is False, nodeid
     references a changeset existing before the rewrite call.
     """
-    wlock = lock = tr = None
+    # Read-only preparation, done before taking the lock. metaedit
+    # currently calls this with wlock+lock+transaction already held, so
+    # the shorter critical section only helps lock-free callers.
+    message = cmdutil.logmessage(repo, commitopts)
+    if not message:
+        message = old.description()
+
+    user = commitopts.get("user") or old.user()
+    date = commitopts.get("date") or None  # old.date()
+    if "extra" in commitopts:
+        extra = dict(commitopts["extra"])
+    else:
+        extra = dict(old.extra())
+    extra["branch"] = old.branch()
+    preds = [old.node()]
+    mutop = "metaedit"
+    mutinfo = mutation.record(repo, extra, preds, mutop)
+    loginfo = {"predecessors": old.hex(), "mutation": mutop}
+
+    new = context.metadataonlyctx(
+        repo,
+        old,
+        parents=newbases,
+        text=message,
+        user=user,
+        date=date,
+        extra=extra,
+        loginfo=loginfo,
+        mutinfo=mutinfo,
+    )
+
+    if commitopts.get("edit"):
+        new._text = cmdutil.commitforceeditor(repo, new)
+
+    # No wlock: a metadata-only commit rewrites the changelog and
+    # mutation store but never touches the working copy, so don't block
+    # concurrent dirstate readers.
+    lock = tr = None
     try:
-        wlock = repo.wlock()
         lock = repo.lock()
         tr = repo.transaction("rewrite")
         updatebookmarks = bookmarksupdater(repo, old.node())
-
-        message = cmdutil.logmessage(repo, commitopts)
-        if not message:
-            message = old.description()
-
-        user = commitopts.get("user") or old.user()
-        date = commitopts.get("date") or None  # old.date()
-        extra = dict(commitopts.get("extra", old.extra()))
-        extra["branch"] = old.branch()
-        preds = [old.node()]
-        mutop = "metaedit"
-        mutinfo = mutation.record(repo, extra, preds, mutop)
-        loginfo = {"predecessors": old.hex(), "mutation": mutop}
-
-        new = context.metadataonlyctx(
-            repo,
-            old,
-            parents=newbases,
-            text=message,
-            user=user,
-            date=date,
-            extra=extra,
-            loginfo=loginfo,
-            mutinfo=mutinfo,
-        )
-
-        if commitopts.get("edit"):
-            new._text = cmdutil.commitforceeditor(repo, new)
         revcount = len(repo)
         newid = repo.commitctx(new)
         new = repo[newid]
@@ -275,7 +342,7 @@ def metarewrite(repo, old, newbases, commitopts):
         tr.close()
         return newid, created
     finally:
-        lockmod.release(tr, lock, wlock)
+        lockmod.release(tr, lock)
 
 
 def newunstable(repo, revs):
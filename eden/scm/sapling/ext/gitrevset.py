@@ -18,9 +18,9 @@ short version:
 from __future__ import absolute_import
 
 import re
-from typing import Pattern
+import time
 
-from sapling import error, hg, namespaces, registrar, revset
+from sapling import error, extensions, hg, namespaces, registrar, revset, smartset, util
 from sapling.i18n import _
 from sapling.namespaces import namespace
 from sapling.node import hex
@@ -29,10 +29,24 @@ from sapling.node import hex
 namespacepredicate = registrar.namespacepredicate()
 revsetpredicate = registrar.revsetpredicate()
 
-githashre: Pattern[str] = re.compile("g([0-9a-fA-F]{40})")
+_hexdigits = frozenset("0123456789abcdefABCDEF")
+
+# Matches g<40-hex> references in raw revset specs, including inside
+# quoted strings; hex digits are word characters, so the boundaries
+# reject longer symbols with a g<40-hex> prefix.
+_githashre = re.compile(r"\bg([0-9a-fA-F]{40})\b")
 
 templatekeyword = registrar.templatekeyword()
 
+# Remote peers reused across _lookup_node calls, keyed by peer path.
+# Building a peer can mean spawning an ssh subprocess and a handshake,
+# so pay that once per process rather than once per lookup.
+_peer_cache = {}
+
+# How long (seconds) a cached "unknown hash" result suppresses another
+# remote lookup. Positive results are immutable and never expire.
+_negativecachettl = 60
+
 
 @templatekeyword("gitnode")
 def showgitnode(repo, ctx, templ, **args):
@@ -61,10 +75,116 @@ def gitnode(repo, subset, x):
         raise error.RepoLookupError(_("unknown revision '%s'") % n)
 
     rev = repo[hexhgnode].rev()
-    return subset.filter(lambda r: r == rev)
+    return subset & smartset.baseset([rev], repo=repo)
+
+
+def extsetup(ui) -> None:
+    # Wrap matchany rather than a later hook like posttreebuilthook:
+    # parsing and scanunknowns() resolve every symbol serially through
+    # repo.__contains__, so the prefetch has to see the raw specs before
+    # the parser does.
+    extensions.wrapfunction(revset, "matchany", _matchany)
+
+
+def reposetup(_ui, repo) -> None:
+    repo._gitlookup_cache = util.lrucachedict(4096)
+
+
+def _matchany(orig, ui, specs, repo=None, localalias=None):
+    if repo is not None:
+        githashes = _scangithashes(specs)
+        if len(githashes) > 1:
+            _prefetchgitnodes(repo, githashes)
+    return orig(ui, specs, repo, localalias)
+
+
+def _scangithashes(specs):
+    """Collect distinct g<40-hex> references from raw revset specs."""
+    githashes = []
+    seen = set()
+    for spec in specs:
+        if not isinstance(spec, str):
+            continue
+        for m in _githashre.finditer(spec):
+            githash = m.group(1)
+            if githash not in seen:
+                seen.add(githash)
+                githashes.append(githash)
+    return githashes
+
+
+def _prefetchgitnodes(repo, githashes):
+    """Resolve several git hashes in one batched remote round trip.
+
+    Seeds the _lookup_node cache so that evaluating an expression like
+    "g<h1> + g<h2> + g<h3>" pays for a single network exchange instead
+    of one per hash.
+    """
+    cache = getattr(repo, "_gitlookup_cache", None)
+    if cache is None:
+        return
+    missing = []
+    for githash in githashes:
+        cachekey = ("git", githash)
+        if cachekey in cache:
+            result, cachetime = cache[cachekey]
+            if result is not None or time.monotonic() - cachetime < _negativecachettl:
+                continue
+        try:
+            cache[cachekey] = (
+                repo.lookup("_gitlookup_git_%s" % githash),
+                time.monotonic(),
+            )
+        except error.RepoLookupError:
+            missing.append(githash)
+    if not missing:
+        return
+    peerpath = repo.ui.expandpath("default")
+    oldfout = repo.ui.fout
+    try:
+        repo.baseui.fout = repo.ui.ferr
+        remoterepo = _peer_cache.get(peerpath)
+        if remoterepo is None:
+            remoterepo = hg.peer(repo, {}, peerpath)
+            _peer_cache[peerpath] = remoterepo
+        batch = remoterepo.iterbatch()
+        for githash in missing:
+            batch.lookup("_gitlookup_git_%s" % githash)
+        batch.submit()
+        for githash, result in zip(missing, batch.results()):
+            cache[("git", githash)] = (
+                result if len(result) == 20 else None,
+                time.monotonic(),
+            )
+    except error.RepoError:
+        # This is only a prefetch; an unknown hash aborts the rest of
+        # the batch and anything left uncached falls back to the
+        # per-hash path in _lookup_node. The abort also tears down the
+        # peer's pipes, so evict it to get a fresh connection there.
+        _peer_cache.pop(peerpath, None)
+    finally:
+        repo.baseui.fout = oldfout
 
 
 def _lookup_node(repo, hexnode, from_scm_type):
+    cache = getattr(repo, "_gitlookup_cache", None)
+    cachekey = (from_scm_type, hexnode)
+    if cache is not None and cachekey in cache:
+        result, cachetime = cache[cachekey]
+        # A negative entry only holds off revalidation for a short
+        # window, so a hash that appears remotely later (e.g. after a
+        # push) is still found.
+        if result is not None or time.monotonic() - cachetime < _negativecachettl:
+            return result
+    result = _lookup_node_uncached(repo, hexnode, from_scm_type)
+    if cache is not None:
+        # Cache negative results (i.e. result=None) too, so unknown
+        # hashes don't hit the remote peer repeatedly.
+        cache[cachekey] = (result, time.monotonic())
+    return result
+
+
+def _lookup_node_uncached(repo, hexnode, from_scm_type):
     gitlookupnode = "_gitlookup_%s_%s" % (from_scm_type, hexnode)
 
     # ui.expandpath('default') returns 'default' if there is no default
@@ -82,12 +202,20 @@ def _lookup_node(repo, hexnode, from_scm_type):
         oldfout = repo.ui.fout
         try:
             repo.baseui.fout = repo.ui.ferr
-            remoterepo = hg.peer(repo, {}, peerpath)
+            remoterepo = _peer_cache.get(peerpath)
+            if remoterepo is None:
+                remoterepo = hg.peer(repo, {}, peerpath)
+                _peer_cache[peerpath] = remoterepo
             result = remoterepo.lookup(gitlookupnode)
+        except error.RepoLookupError:
+            # The peer is healthy but doesn't know the hash; keep the
+            # connection around for the next lookup.
+            return None
         except error.RepoError:
-            # Note: RepoError can be thrown by hg.peer(), RepoLookupError
-            # can be thrown by remoterepo.lookup(). RepoLookupError is a
-            # subclass of RepoError so catching just error.RepoError is enough.
+            # Note: RepoError can be thrown by hg.peer() when the peer
+            # itself is broken or unreachable. Evict it so a dead
+            # connection is rebuilt next time.
+            _peer_cache.pop(peerpath, None)
             return None
         finally:
             repo.baseui.fout = oldfout
@@ -107,11 +235,12 @@ def _getnamespace(_repo) -> namespace:
 
 
 def _gitlookup(repo, gitrev):
-    def _gittohg(githash):
-        return list(repo.nodes("gitnode(%s)" % githash))
-
-    m = githashre.match(gitrev)
-    if m is not None:
-        return _gittohg(m.group(1))
-    else:
+    # The namespace is consulted for every symbol a user types. The
+    # pattern is trivial and fixed-length ("g" + 40 hex digits), so a
+    # hand-rolled scan beats spinning up the regex engine per symbol.
+    if len(gitrev) != 41 or gitrev[0] != "g":
+        return []
+    githash = gitrev[1:]
+    if not all(c in _hexdigits for c in githash):
         return []
+    return list(repo.nodes("gitnode(%s)" % githash))
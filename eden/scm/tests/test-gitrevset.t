@@ -0,0 +1,97 @@
+#require no-eden
+
+#chg-compatible
+
+  $ configure dummyssh
+  $ enable gitrevset
+
+Set up a server repo with a side extension resolving the
+_gitlookup_git_* keys that gitrevset sends over the wire, backed by a
+git hash -> hg node map in .hg/gitmap. It also logs every wire command
+the server dispatches so the tests below can tell a batched exchange
+from serial lookups.
+
+  $ hg init server
+  $ cd server
+  $ cat > gitmapext.py <<EOF
+  > import os
+  > from sapling import extensions, namespaces, registrar, wireproto
+  > from sapling.node import bin
+  > namespacepredicate = registrar.namespacepredicate()
+  > def extsetup(ui):
+  >     def logdispatch(orig, repo, proto, command):
+  >         with open(os.path.join(os.environ["TESTTMP"], "wirelog"), "a") as f:
+  >             f.write("%s\n" % command)
+  >         return orig(repo, proto, command)
+  >     extensions.wrapfunction(wireproto, "dispatch", logdispatch)
+  > @namespacepredicate("gitmap", priority=80)
+  > def _gitmapns(_repo):
+  >     return namespaces.namespace(
+  >         listnames=lambda repo: [],
+  >         namemap=_gitmaplookup,
+  >         nodemap=lambda repo, node: [],
+  >     )
+  > def _gitmaplookup(repo, name):
+  >     if not name.startswith("_gitlookup_git_"):
+  >         return []
+  >     githash = name[len("_gitlookup_git_"):]
+  >     for line in repo.localvfs.tryread("gitmap").decode().splitlines():
+  >         g, h = line.split()
+  >         if g == githash:
+  >             return [bin(h)]
+  >     return []
+  > EOF
+  $ setconfig "extensions.gitmapext=$TESTTMP/server/gitmapext.py"
+  $ echo a > a
+  $ hg commit -qAm a
+  $ echo b > b
+  $ hg commit -qAm b
+  $ echo "1111111111111111111111111111111111111111 $(hg log -r 'desc(a)' -T '{node}')" >> .hg/gitmap
+  $ echo "3333333333333333333333333333333333333333 $(hg log -r 'desc(b)' -T '{node}')" >> .hg/gitmap
+  $ cd ..
+
+A client that only knows the hashes through the remote peer.
+
+  $ hg clone -q ssh://user@dummy/server client
+  $ cd client
+  $ readwirelog() {
+  >   grep -Ex "lookup|batch" "$TESTTMP/wirelog"
+  >   rm -f "$TESTTMP/wirelog"
+  > }
+  $ rm -f "$TESTTMP/wirelog"
+
+A single hash resolves through one plain lookup, via the gitnode revset
+or the g<hash> shortcut.
+
+  $ hg log -r "gitnode(1111111111111111111111111111111111111111)" -T '{desc}\n'
+  a
+  $ hg log -r "g3333333333333333333333333333333333333333" -T '{desc}\n'
+  b
+  $ readwirelog
+  lookup
+  lookup
+
+Multiple hashes in one expression are prefetched with a single batch
+wire command instead of one lookup round trip per hash.
+
+  $ hg log -r "g1111111111111111111111111111111111111111 + g3333333333333333333333333333333333333333" -T '{desc}\n'
+  a
+  b
+  $ readwirelog
+  batch
+
+A mix of known and unknown hashes reports the unknown revision rather
+than crashing: the failed batch tears down the peer, and the per-hash
+fallback retries the unknown hash on a fresh connection.
+
+  $ hg log -r "g1111111111111111111111111111111111111111 + g2222222222222222222222222222222222222222" -T '{desc}\n'
+  abort: unknown revision 'g2222222222222222222222222222222222222222'!
+  [255]
+  $ readwirelog
+  batch
+  lookup
+
+And lookups keep working afterwards.
+
+  $ hg log -r "g3333333333333333333333333333333333333333" -T '{desc}\n'
+  b